@@ -1,18 +1,67 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 import os
-import json
+import io
 import csv
-from typing import Optional
+import re
+import time
+import asyncio
+import hashlib
+import functools
+from collections import OrderedDict
+from enum import Flag
+from typing import Dict, Optional
+import httpx
 import openai
+import diskcache
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# --- Upload Size Limit ---
+# Largest request body accepted; bigger uploads are rejected with 413
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 << 20)))
+
+class MaxBodySizeMiddleware:
+    """Reject request bodies over max_bytes before they are buffered or spooled."""
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"Request body exceeds {self.max_bytes} bytes"
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": detail}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        # Chunked uploads carry no Content-Length, so also count bytes as they arrive
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 app = FastAPI(title="IITM DS Assignment Solver",
               description="API for solving graded assignments and processing files")
 
+app.add_middleware(MaxBodySizeMiddleware, max_bytes=MAX_UPLOAD_BYTES)
+
 # CORS Configuration
 app.add_middleware(
     CORSMiddleware,
@@ -23,8 +72,16 @@ app.add_middleware(
 
 # --- Configuration ---
 AIPROXY_TOKEN = os.getenv("AIPROXY_TOKEN")
-openai.api_base = "https://aiproxy.sanand.workers.dev/openai/v1"
-openai.api_key = AIPROXY_TOKEN
+AIPROXY_BASE_URL = "https://aiproxy.sanand.workers.dev/openai/v1"
+# Request and token budgets for the AI Proxy, enforced locally before each call
+LLM_MAX_RPM = int(os.getenv("LLM_MAX_RPM", "500"))
+LLM_MAX_TPM = int(os.getenv("LLM_MAX_TPM", "200000"))
+# On-disk answer cache shared by workers and kept across restarts (/tmp is
+# the only writable path on Vercel)
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "/tmp/tds_llm")
+LLM_CACHE_TTL = 24 * 60 * 60
+# Answers kept in the in-process LRU in front of the disk cache
+LLM_CACHE_SIZE = 1024
 
 # --- Predefined Questions and Answers ---
 predefined_answers = {
@@ -59,68 +116,289 @@ predefined_answers = {
     "What is the total margin for transactions before Sat Mar 12 2022 10:02:11 GMT+0530 (India Standard Time) for Gamma sold in BR ? ": "0.5154"
 }
 
-# --- Core Functions ---
-async def get_llm_answer(question: str) -> str:
-    """Dynamically generates an SQL query or a general answer based on the question."""
-    # Check if the question explicitly mentions SQL or query-related keywords
-    if any(keyword in question.lower() for keyword in ["sql", "query", "duckdb"]):
-        prompt = f"""You are an expert assistant. Analyze the following question and respond appropriately:
+# Normalized (lowercased, stripped) question -> answer for exact matches, and
+# lowercased-only keys for partial matches, both built once at import
+_NORMALIZED_ANSWERS = {q.lower().strip(): a for q, a in predefined_answers.items()}
+_PARTIAL_ANSWERS = {q.lower(): a for q, a in predefined_answers.items()}
+# Single alternation over every predefined question, longest first so the most
+# specific question wins when one is a prefix of another. Each question gets its
+# own group and answers are looked up by group index, since IGNORECASE matches
+# text that str.lower() would not map back to the key (e.g. "ſ" for "s")
+_PARTIAL_KEYS = sorted(_PARTIAL_ANSWERS, key=len, reverse=True)
+_PARTIAL_ANSWERS_BY_GROUP = [_PARTIAL_ANSWERS[q] for q in _PARTIAL_KEYS]
+_PREDEFINED_RE = re.compile(
+    "|".join(f"({re.escape(q)})" for q in _PARTIAL_KEYS),
+    re.IGNORECASE
+)
+
+# --- Question Classification ---
+class QuestionKind(Flag):
+    NONE = 0
+    TOTAL_MARGIN = 1  # Handled from the uploaded CSV
+    SQL = 2  # Explicitly mentions SQL or query-related keywords
+
+_QUESTION_KIND_RE = re.compile(r"(total margin for transactions)|(sql|query|duckdb)", re.IGNORECASE)
+
+# Longer questions are classified without caching, so the memo can't pin
+# thousands of oversized form fields in memory
+CLASSIFY_CACHE_MAX_LEN = 2048
+
+def _classify_question(question: str) -> QuestionKind:
+    kind = QuestionKind.NONE
+    for match in _QUESTION_KIND_RE.finditer(question):
+        kind |= QuestionKind.TOTAL_MARGIN if match.group(1) else QuestionKind.SQL
+    return kind
+
+_classify_question_cached = functools.lru_cache(maxsize=4096)(_classify_question)
+
+def classify_question(question: str) -> QuestionKind:
+    """Classify a question in one regex pass; memoized since questions repeat across users."""
+    if len(question) > CLASSIFY_CACHE_MAX_LEN:
+        return _classify_question(question)
+    return _classify_question_cached(question)
+
+# --- Prompt Templates ---
+SQL_PROMPT = """You are an expert assistant. Analyze the following question and respond appropriately:
         - If the question requires an SQL query, generate the SQL query.
         - If the question is general or unrelated to SQL, provide a concise and accurate answer.
         - Return ONLY the answer or SQL query without any explanation or additional text.
 
-        Question: {question}"""
-    else:
-        prompt = f"""You are an expert assistant. Analyze the following question and respond appropriately:
+        Question: {}"""
+
+GENERAL_PROMPT = """You are an expert assistant. Analyze the following question and respond appropriately:
         - Provide a concise and accurate answer.
         - Do NOT generate SQL queries unless explicitly asked.
         - Return ONLY the answer without any explanation or additional text.
 
-        Question: {question}"""
+        Question: {}"""
 
-    response = openai.ChatCompletion.create(
+# --- LLM Client, Rate Limiting and Caching ---
+_client: Optional[openai.AsyncOpenAI] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def _openai_client() -> openai.AsyncOpenAI:
+    """Return the AsyncOpenAI client for the running event loop."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    # Pooled connections belong to the loop that opened them. Runtimes that
+    # start a fresh loop per invocation get a fresh client; the previous one
+    # is dropped (its loop is gone, so it can't be awaited closed) and GC
+    # closes its sockets. Created lazily so import works without AIPROXY_TOKEN
+    if _client is None or _client_loop is not loop:
+        _client = openai.AsyncOpenAI(
+            base_url=AIPROXY_BASE_URL,
+            api_key=AIPROXY_TOKEN,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+            ),
+        )
+        _client_loop = loop
+    return _client
+
+@app.on_event("shutdown")
+async def close_openai_client():
+    """Close the pooled connections when a long-lived server shuts down."""
+    global _client, _client_loop
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.close()
+    _client = None
+    _client_loop = None
+
+async def _call_openai(prompt: str) -> str:
+    """OpenAI roundtrip for a single prompt."""
+    response = await _openai_client().chat.completions.create(
         model="gpt-4o-mini",
         messages=[{"role": "user", "content": prompt}],
         temperature=0
     )
     return response.choices[0].message.content.strip()
 
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) for TPM accounting."""
+    return len(text) // 4 + 1
+
+class RateLimiter:
+    """Proactive token bucket for requests-per-minute and tokens-per-minute budgets."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int):
+        """Wait until one request and `tokens` tokens fit in the budget, then spend them."""
+        tokens = min(tokens, self.tpm)
+        while True:
+            self._refill()
+            if self._requests >= 1 and self._tokens >= tokens:
+                self._requests -= 1
+                self._tokens -= tokens
+                return
+            await asyncio.sleep(max(
+                (1 - self._requests) * 60 / self.rpm,
+                (tokens - self._tokens) * 60 / self.tpm,
+            ))
+
+_rate_limiter = RateLimiter(LLM_MAX_RPM, LLM_MAX_TPM)
+
+async def _limited_call_openai(prompt: str) -> str:
+    """Await an OpenAI call once the rate limiter admits it."""
+    await _rate_limiter.acquire(_estimate_tokens(prompt))
+    return await _call_openai(prompt)
+
+# Bounded LRU of prompt digest -> answer, backed by a size-limited disk cache.
+# Keying on the SHA-256 digest keeps large prompts from being pinned in memory
+_answer_cache: "OrderedDict[str, str]" = OrderedDict()
+# Short SQLite lock timeout: a busy cache is treated as a miss instead of
+# stalling requests behind another worker's write
+_disk_cache = diskcache.Cache(LLM_CACHE_DIR, size_limit=512 << 20, timeout=1)
+
+def _prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def _remember_answer(key: str, answer: str):
+    _answer_cache[key] = answer
+    if len(_answer_cache) > LLM_CACHE_SIZE:
+        _answer_cache.popitem(last=False)
+
+async def _disk_cache_get(key: str) -> Optional[str]:
+    """Read a cached answer in a worker thread; None on a miss or lock timeout."""
+    try:
+        return await asyncio.to_thread(_disk_cache.get, key)
+    except diskcache.Timeout:
+        return None
+
+async def _disk_cache_set(key: str, answer: str):
+    """Store an answer in a worker thread, skipping it if the cache is locked."""
+    try:
+        await asyncio.to_thread(_disk_cache.set, key, answer, expire=LLM_CACHE_TTL)
+    except diskcache.Timeout:
+        pass
+
+# Prompt digests currently being answered, so concurrent duplicates share one call
+_inflight: Dict[str, "asyncio.Task[str]"] = {}
+
+async def _fetch_answer(key: str, prompt: str) -> str:
+    """Request a fresh answer and store it in both caches."""
+    answer = await _limited_call_openai(prompt)
+    _remember_answer(key, answer)
+    await _disk_cache_set(key, answer)
+    return answer
+
+def _finish_inflight(key: str, task: "asyncio.Task[str]"):
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    # Mark failures retrieved so they aren't logged when every caller has gone
+    if not task.cancelled():
+        task.exception()
+
+async def _cached_llm_call(prompt: str) -> str:
+    """Answer a prompt from the LRU or disk cache, an in-flight call, or a new OpenAI request."""
+    key = _prompt_key(prompt)
+    answer = _answer_cache.get(key)
+    if answer is not None:
+        _answer_cache.move_to_end(key)
+        return answer
+
+    answer = await _disk_cache_get(key)
+    if answer is not None:
+        _remember_answer(key, answer)
+        return answer
+
+    # The call runs as its own task, so a caller disconnecting cancels only its
+    # own wait and never the answer other callers are waiting for
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_answer(key, prompt))
+        _inflight[key] = task
+        task.add_done_callback(functools.partial(_finish_inflight, key))
+    return await asyncio.shield(task)
+
+# --- Core Functions ---
+async def get_llm_answer(question: str) -> str:
+    """Dynamically generates an SQL query or a general answer based on the question."""
+    template = SQL_PROMPT if QuestionKind.SQL in classify_question(question) else GENERAL_PROMPT
+    prompt = template.format(question)
+    return await _cached_llm_call(prompt)
+
 def get_predefined_answer(question: str) -> Optional[str]:
-    """Check if the question partially matches any predefined answers."""
-    for predefined_question, answer in predefined_answers.items():
-        if predefined_question.lower() in question.lower():
-            return answer
-    return None
+    """Check if the question exactly or partially matches any predefined answers."""
+    normalized = question.lower().strip()
+    answer = _NORMALIZED_ANSWERS.get(normalized)
+    if answer is not None:
+        return answer
+    match = _PREDEFINED_RE.search(question)
+    return _PARTIAL_ANSWERS_BY_GROUP[match.lastindex - 1] if match else None
 
-def process_file(file: UploadFile, question: str) -> str:
-    """Process the uploaded file based on the question."""
+def calculate_total_margin(lines) -> str:
+    """Calculate the margin for Gamma sold in BR before the cutoff date from CSV lines."""
+    reader = csv.reader(lines)
+    # next() without a default would raise StopIteration, which asyncio cannot
+    # propagate out of a to_thread() worker
+    header = next(reader, None)
+    if header is None:
+        raise ValueError("empty CSV")
+    # Index columns once instead of building a dict per row
+    country_idx = header.index("Country")
+    product_idx = header.index("Product")
+    date_idx = header.index("Date")
+    sales_idx = header.index("Sales")
+    cost_idx = header.index("Cost")
+
+    total_sales, total_cost = 0, 0
+    for row in reader:
+        # Skip blank lines, as DictReader did
+        if not row:
+            continue
+        # Standardize country names
+        if row[country_idx].strip().upper() not in ("BR", "BRAZIL"):
+            continue
+        # Extract product name before the slash
+        if row[product_idx].split("/", 1)[0].strip().lower() != "gamma":
+            continue
+        # Filter by date (ISO 8601 strings compare chronologically)
+        if row[date_idx].strip() > "2022-03-12T10:02:11":
+            continue
+        sales = float(row[sales_idx].replace("USD", "").strip())
+        # Rows missing trailing fields have no cost, like DictReader's restval
+        cost_value = row[cost_idx] if len(row) > cost_idx else None
+        cost = float(cost_value.replace("USD", "").strip()) if cost_value else sales * 0.5
+        total_sales += sales
+        total_cost += cost
+    margin = (total_sales - total_cost) / total_sales
+    return f"{margin:.4f}"
+
+def _margin_from_upload(stream) -> str:
+    """Run calculate_total_margin directly over the uploaded file object."""
+    # SpooledTemporaryFile only grew the full io interface (readable() etc.)
+    # in Python 3.11; on older versions wrap its underlying BytesIO/TemporaryFile
+    raw = stream if hasattr(stream, "readable") else stream._file
+    raw.seek(0)
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
     try:
-        # Read the file content
-        content = file.file.read().decode("utf-8")
+        return calculate_total_margin(text)
+    finally:
+        # Leave the upload open; FastAPI closes it after the request
+        text.detach()
 
+async def process_file(file: UploadFile, question: str) -> str:
+    """Process the uploaded file based on the question."""
+    try:
         # Handle specific file types or questions
-        if "total margin for transactions" in question.lower():
-            # Parse CSV and calculate margin
-            reader = csv.DictReader(content.splitlines())
-            total_sales, total_cost = 0, 0
-            for row in reader:
-                # Standardize country names
-                country = row["Country"].strip().upper()
-                if country in ["BR", "BRAZIL"]:
-                    # Extract product name before the slash
-                    product = row["Product"].split("/")[0].strip()
-                    if product.lower() == "gamma":
-                        # Filter by date
-                        sale_date = row["Date"].strip()
-                        # Convert date to a comparable format (e.g., ISO 8601)
-                        # Assuming the date is in "YYYY-MM-DD" format
-                        if sale_date <= "2022-03-12T10:02:11":
-                            sales = float(row["Sales"].replace("USD", "").strip())
-                            cost = float(row["Cost"].replace("USD", "").strip()) if row["Cost"] else sales * 0.5
-                            total_sales += sales
-                            total_cost += cost
-            margin = (total_sales - total_cost) / total_sales
-            return f"{margin:.4f}"
+        if QuestionKind.TOTAL_MARGIN in classify_question(question):
+            # Parse straight from the spooled upload in a worker thread instead
+            # of copying it into memory and splitting it into a list of lines
+            return await asyncio.to_thread(_margin_from_upload, file.file)
 
         # Add more file processing logic as needed
         return "File processed successfully, but no specific logic implemented for this question."
@@ -147,7 +425,7 @@ async def solve_assignment(
 
         # Step 2: If a file is attached, process it
         if file:
-            file_answer = process_file(file, question)
+            file_answer = await process_file(file, question)
             return {"answer": file_answer}
 
         # Step 3: If no predefined answer or file, use OpenAI to generate the answer